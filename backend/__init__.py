@@ -1,3 +1,8 @@
+import time
+
+# Used to report how long each worker process takes to start
+started_at = time.perf_counter()
+
 from backend.database.config import SessionLocal
 
 # Common db dependency
@@ -1,9 +1,10 @@
 from fastapi import FastAPI
-from .routers import user, transaction
+from .routers import user, transaction, expiry, payer, health
 
-from backend.database.config import engine, Base
+from backend.sweeper import sweeper
+from backend.warmup import warm_up
 
-Base.metadata.create_all(bind=engine)
+# The schema is set up once by backend/serve.py (or backend/main.py in dev), not by every worker on import
 
 # Create the main app
 app = FastAPI()
@@ -11,7 +12,28 @@ app = FastAPI()
 # Include the routers for different resources
 app.include_router(user.router)
 app.include_router(transaction.router)
+app.include_router(expiry.router)
+app.include_router(payer.router)
+app.include_router(health.router)
+
+
+@app.on_event("startup")
+def prepare_worker():
+    warm_up()
+
+
+@app.on_event("startup")
+def start_sweeper():
+    # The background sweeper is opt-in through EXPIRY_SWEEP_INTERVAL_SECONDS
+    if sweeper.interval > 0:
+        sweeper.start()
+
+
+@app.on_event("shutdown")
+def stop_sweeper():
+    sweeper.stop()
+
 
 @app.get("/")
 async def root():
-    return {"message": "this is a backend service"}
+    return {"message": "this is a backend service"}
\ No newline at end of file
@@ -0,0 +1,99 @@
+import argparse
+import subprocess
+import sys
+import threading
+import time
+
+import requests
+
+
+def wait_for_workers(url: str, workers: int, timeout: float):
+    """
+    Poll the readiness endpoint until every worker has answered. Returns the cold start each worker reports in ms,
+    measured from the creation of its process
+    """
+    cold_starts = {}
+    deadline = time.monotonic() + timeout
+
+    while len(cold_starts) < workers:
+        if time.monotonic() > deadline:
+            raise RuntimeError(f"Only {len(cold_starts)} of {workers} workers became ready")
+        try:
+            # A new connection each time so requests get spread over the workers
+            response = requests.get(f"{url}/health/ready", headers={"Connection": "close"}, timeout=1)
+            if response.status_code == 200:
+                body = response.json()
+                cold_starts[body["pid"]] = body["cold_start_ms"]
+        except requests.RequestException:
+            pass
+
+        # Poll gently, so the poller doesn't slow down the workers it is timing
+        time.sleep(0.05)
+
+    return list(cold_starts.values())
+
+
+def measure_throughput(url: str, path: str, concurrency: int, duration: float):
+    """
+    Send requests from `concurrency` threads for `duration` seconds. Returns requests per second
+    """
+    counts = [0] * concurrency
+    stop = time.monotonic() + duration
+
+    def send(index):
+        with requests.Session() as session:
+            while time.monotonic() < stop:
+                session.get(f"{url}{path}").raise_for_status()
+                counts[index] += 1
+
+    threads = [threading.Thread(target=send, args=(i,)) for i in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    return sum(counts) / duration
+
+
+def run(workers: int, port: int, path: str, concurrency: int, duration: float):
+    url = f"http://127.0.0.1:{port}"
+    server = subprocess.Popen(
+        [sys.executable, "-m", "backend.serve", "--workers", str(workers), "--port", str(port), "--host", "127.0.0.1", "--skip-init"],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+
+    try:
+        cold_starts = wait_for_workers(url, workers, timeout=60)
+        throughput = measure_throughput(url, path, concurrency, duration)
+    finally:
+        server.terminate()
+        server.wait()
+
+    return cold_starts, throughput
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Measure worker cold start and throughput for different numbers of workers")
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--port", type=int, default=8100)
+    parser.add_argument("--path", default="/payers/", help="Endpoint to load")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--duration", type=float, default=10)
+    args = parser.parse_args(argv)
+
+    subprocess.run([sys.executable, "-m", "backend.serve", "--init-only"], check=True)
+
+    print(f"{'workers':>8} {'cold start avg ms':>18} {'cold start max ms':>18} {'req/s':>10} {'scaling':>8}")
+    baseline = None
+    for workers in args.workers:
+        cold_starts, throughput = run(workers, args.port, args.path, args.concurrency, args.duration)
+        baseline = baseline or throughput
+        print(
+            f"{workers:>8} {sum(cold_starts) / len(cold_starts):>18.1f} {max(cold_starts):>18.1f} "
+            f"{throughput:>10.1f} {throughput / baseline:>7.2f}x"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,124 @@
+from collections import defaultdict
+from datetime import datetime
+from sqlalchemy import and_, or_, bindparam
+from sqlalchemy.orm import Session
+
+from backend.crud import payer as payer_crud
+from backend.schemas import ExpiryPolicyIn
+from backend.models import ExpiryPolicy, ExpiryEvent, Transaction
+
+
+def get_policy(db: Session, payer: str):
+    """
+    Returns the expiry policy of a payer
+    """
+    return db.query(ExpiryPolicy).filter(ExpiryPolicy.payer == payer).first()
+
+
+def get_policies(db: Session):
+    """
+    Returns all expiry policies
+    """
+    return db.query(ExpiryPolicy).order_by(ExpiryPolicy.payer).all()
+
+
+def set_policy(db: Session, payer: str, policy: ExpiryPolicyIn):
+    """
+    Create or replace the expiry policy of a payer
+    """
+    db_policy = get_policy(db=db, payer=payer)
+
+    if db_policy:
+        db_policy.expire_after_days = policy.expire_after_days
+    else:
+        db_policy = ExpiryPolicy(payer=payer, **policy.dict())
+        db.add(db_policy)
+
+    db.commit()
+    db.refresh(db_policy)
+    return db_policy
+
+
+def delete_policy(db: Session, payer: str):
+    """
+    Remove the expiry policy of a payer. Returns whether a policy existed
+    """
+    deleted = db.query(ExpiryPolicy).filter(ExpiryPolicy.payer == payer).delete()
+    db.commit()
+    return deleted > 0
+
+
+def get_expiry_events(db: Session, user_id: str = None, skip: int = 0, limit: int = 10):
+    """
+    Returns expiry events, newest first. If user is indicated, select only events for that user
+    """
+    query = db.query(ExpiryEvent)
+
+    if user_id:
+        query = query.filter(ExpiryEvent.user_id == user_id)
+
+    return query.order_by(ExpiryEvent.expired_at.desc()).offset(skip).limit(limit).all()
+
+
+def get_expirable_transactions(db: Session, payer: str, cutoff: datetime, limit: int, after=None):
+    """
+    Get up to `limit` of the oldest transactions of a payer with unused positive points dated before the cutoff.
+    `after` is the (transaction_date, id) of the last transaction of the previous batch, to carry on from there
+    """
+    query = db.query(Transaction.id, Transaction.user_id, Transaction.payer, Transaction.points, Transaction.used_points, Transaction.transaction_date).\
+        filter(Transaction.payer == payer, Transaction.transaction_date < cutoff, Transaction.points > 0, Transaction.used_points < Transaction.points)
+
+    if after:
+        after_date, after_id = after
+        query = query.filter(or_(
+            Transaction.transaction_date > after_date,
+            and_(Transaction.transaction_date == after_date, Transaction.id > after_id),
+        ))
+
+    return query.order_by(Transaction.transaction_date, Transaction.id).limit(limit).all()
+
+
+def expire_transactions(db: Session, transactions, expired_at: datetime):
+    """
+    Mark the given transactions as fully used and record an expiry event for each, with one statement each. Does not commit.
+    Returns the recorded events, or None if any transaction changed since it was read, e.g. by a deduct.
+    In that case the caller should roll back and read them again
+    """
+    if not transactions:
+        return []
+
+    table = Transaction.__table__
+
+    # Only expire rows whose used points are still what we read. The update also takes the write lock,
+    # so nothing else can change before the commit
+    result = db.execute(
+        table.update().
+        where(and_(table.c.id == bindparam("lot_id"), table.c.used_points == bindparam("seen_used_points"))).
+        values(used_points=table.c.points),
+        [{"lot_id": t.id, "seen_used_points": t.used_points} for t in transactions],
+    )
+
+    if result.rowcount != len(transactions):
+        return None
+
+    events = [
+        {
+            "transaction_id": t.id,
+            "user_id": t.user_id,
+            "payer": t.payer,
+            "points": t.points - t.used_points,
+            "expired_at": expired_at,
+        }
+        for t in transactions
+    ]
+    db.execute(ExpiryEvent.__table__.insert(), events)
+
+    # Expired points count as consumed in the payer totals
+    expired_by_payer = defaultdict(int)
+    for event in events:
+        expired_by_payer[event["payer"]] += event["points"]
+
+    for payer, points in expired_by_payer.items():
+        payer_crud.add_to_payer_liability(db=db, payer=payer, consumed=points)
+
+    return events
@@ -0,0 +1,85 @@
+import json
+from datetime import datetime
+
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+
+from backend.models import IdempotencyRecord
+
+
+def get_record(db: Session, key: str):
+    """
+    Returns the record of an idempotency key, as currently stored in the DB
+    """
+    return db.query(IdempotencyRecord).populate_existing().filter(IdempotencyRecord.key == key).first()
+
+
+def get_latest_records(db: Session, limit: int, since: datetime):
+    """
+    Returns the most recently stored responses created after `since`
+    """
+    return db.query(IdempotencyRecord).\
+        filter(IdempotencyRecord.status_code != None, IdempotencyRecord.created_at >= since).\
+        order_by(IdempotencyRecord.created_at.desc()).limit(limit).all()
+
+
+def create_pending_record(db: Session, key: str, fingerprint: str):
+    """
+    Claim an idempotency key for a request that is about to run. Returns the claim time,
+    or None if the key is already taken
+    """
+    claimed_at = datetime.utcnow()
+    # Insert directly, so the primary key decides who gets the key even if this session already loaded the record
+    try:
+        db.execute(IdempotencyRecord.__table__.insert().values(key=key, fingerprint=fingerprint, claimed_at=claimed_at, created_at=claimed_at))
+        db.commit()
+    except IntegrityError:
+        db.rollback()
+        return None
+
+    return claimed_at
+
+
+def take_over_record(db: Session, key: str, seen_claimed_at: datetime):
+    """
+    Claim a pending key whose request seems to have died. Returns the new claim time,
+    or None if the key was completed or claimed by someone else in the meantime
+    """
+    claimed_at = datetime.utcnow()
+    updated = db.query(IdempotencyRecord).\
+        filter(IdempotencyRecord.key == key, IdempotencyRecord.status_code == None, IdempotencyRecord.claimed_at == seen_claimed_at).\
+        update({IdempotencyRecord.claimed_at: claimed_at}, synchronize_session=False)
+    db.commit()
+
+    return claimed_at if updated else None
+
+
+def complete_record(db: Session, key: str, claimed_at: datetime, status_code: int, content):
+    """
+    Store the response of a claimed key in the current DB transaction. Does not commit.
+    Returns False if the claim was taken over by another request
+    """
+    updated = db.query(IdempotencyRecord).\
+        filter(IdempotencyRecord.key == key, IdempotencyRecord.status_code == None, IdempotencyRecord.claimed_at == claimed_at).\
+        update({IdempotencyRecord.status_code: status_code, IdempotencyRecord.body: json.dumps(content)}, synchronize_session=False)
+
+    return updated > 0
+
+
+def delete_pending_record(db: Session, key: str, claimed_at: datetime):
+    """
+    Release a claimed key, so a retry can run the request again
+    """
+    db.query(IdempotencyRecord).\
+        filter(IdempotencyRecord.key == key, IdempotencyRecord.status_code == None, IdempotencyRecord.claimed_at == claimed_at).\
+        delete(synchronize_session=False)
+    db.commit()
+
+
+def delete_records_older_than(db: Session, cutoff: datetime):
+    """
+    Remove records created before the cutoff. Returns the number removed
+    """
+    deleted = db.query(IdempotencyRecord).filter(IdempotencyRecord.created_at < cutoff).delete(synchronize_session=False)
+    db.commit()
+    return deleted
@@ -0,0 +1,57 @@
+from sqlalchemy import case, func
+from sqlalchemy.orm import Session
+
+from backend.models import PayerLiability, Transaction
+
+
+def get_payer_liability(db: Session, payer: str):
+    """
+    Returns the running totals of a single payer
+    """
+    return db.query(PayerLiability).filter(PayerLiability.payer == payer).first()
+
+
+def get_payer_liabilities(db: Session):
+    """
+    Returns the running totals of all payers
+    """
+    return db.query(PayerLiability).order_by(PayerLiability.payer).all()
+
+
+def add_to_payer_liability(db: Session, payer: str, issued: int = 0, consumed: int = 0, users: int = 0):
+    """
+    Add to the running totals of a payer in the current DB transaction. Does not commit
+    """
+    # Increment in SQL so concurrent writers can't overwrite each other's totals
+    updated = db.query(PayerLiability).filter(PayerLiability.payer == payer).update({
+        PayerLiability.issued_points: PayerLiability.issued_points + issued,
+        PayerLiability.consumed_points: PayerLiability.consumed_points + consumed,
+        PayerLiability.user_count: PayerLiability.user_count + users,
+    }, synchronize_session=False)
+
+    if not updated:
+        db.add(PayerLiability(payer=payer, issued_points=issued, consumed_points=consumed, user_count=users))
+        db.flush()
+
+
+def recompute_payer_liabilities(db: Session):
+    """
+    Rebuild the running totals of all payers from the transactions table with a single grouped query
+    """
+    # Only positive transactions issue points. Negative ones are recorded as used on the positive ones they reduce
+    issued = func.sum(case([(Transaction.points > 0, Transaction.points)], else_=0))
+    consumed = func.sum(case([(Transaction.points > 0, Transaction.used_points)], else_=0))
+    users = func.count(func.distinct(Transaction.user_id))
+
+    # Delete first: pysqlite only starts a DB transaction on a write, and the write lock it takes keeps other
+    # writers out until the commit, so no transaction can change between the grouped query and the rebuild
+    db.query(PayerLiability).delete(synchronize_session=False)
+    rows = db.query(Transaction.payer, issued, consumed, users).group_by(Transaction.payer).all()
+
+    db.add_all([
+        PayerLiability(payer=payer, issued_points=issued or 0, consumed_points=consumed or 0, user_count=users)
+        for payer, issued, consumed, users in rows
+    ])
+    db.commit()
+
+    return get_payer_liabilities(db=db)
@@ -23,28 +23,47 @@ def get_transactions(user_id, db: Session, skip: int = 0, limit: int = 10):
 
 def get_all_active_transactions(db: Session, user_id: str):
     """
-    Get all transactions with unused points, sorted by old to late
+    Get all transactions with unused points, sorted by old to late. Always reads the current values from the DB
     """
-    return db.query(Transaction).\
+    return db.query(Transaction).populate_existing().\
         filter(Transaction.user_id == user_id, Transaction.points != Transaction.used_points).\
         order_by(Transaction.transaction_date).all()
 
 
 def get_all_active_transactions_of_payer(db: Session, user_id: str, payer: str):
     """
-    Get all transactions with unused positive points of a specific payer
+    Get all transactions with unused positive points of a specific payer. Always reads the current values from the DB
     """
-    return db.query(Transaction).\
+    return db.query(Transaction).populate_existing().\
         filter(Transaction.user_id == user_id, Transaction.points != Transaction.used_points, Transaction.payer == payer, Transaction.points > 0).\
         order_by(Transaction.transaction_date).all()
 
 
 def create_transaction(db: Session, transaction: TransactionIn, user_id: str):
     """
-    Create a transaction in the DB
+    Create a transaction in the DB. Does not commit, so the caller can commit it together with related changes
     """
     db_transaction = Transaction(**transaction.dict(), user_id=user_id)
     db.add(db_transaction)
-    db.commit()
+    db.flush()
     db.refresh(db_transaction)
-    return db_transaction
\ No newline at end of file
+    return db_transaction
+
+
+def use_points(db: Session, transaction: Transaction, points: int):
+    """
+    Add to the used points of a transaction, only if they haven't changed since it was read,
+    e.g. by the expiry sweeper. Does not commit. Returns whether the transaction was updated
+    """
+    updated = db.query(Transaction).\
+        filter(Transaction.id == transaction.id, Transaction.used_points == transaction.used_points).\
+        update({Transaction.used_points: Transaction.used_points + points}, synchronize_session=False)
+
+    return updated > 0
+
+
+def user_has_other_transactions_of_payer(db: Session, user_id: str, payer: str, transaction_id: str):
+    """
+    Check whether the user has any transaction from a specific payer, other than the given one
+    """
+    return db.query(db.query(Transaction).filter(Transaction.user_id == user_id, Transaction.payer == payer, Transaction.id != transaction_id).exists()).scalar()
\ No newline at end of file
@@ -1,13 +1,34 @@
+import os
+
 from sqlalchemy import create_engine
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import QueuePool
 
 # Make a local database
 SQLALCHEMY_DATABASE_URL = "sqlite:///./app.db"
 
+# Connections kept open per worker process, so requests don't pay for opening a new one
+DB_POOL_SIZE = int(os.environ.get("DB_POOL_SIZE", 5))
+
 engine = create_engine(
-    SQLALCHEMY_DATABASE_URL, connect_args={"check_same_thread": False}
+    SQLALCHEMY_DATABASE_URL, connect_args={"check_same_thread": False}, poolclass=QueuePool, pool_size=DB_POOL_SIZE
 )
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
-Base = declarative_base()
\ No newline at end of file
+Base = declarative_base()
+
+
+def init_db(bind=engine):
+    """
+    Create any missing tables. Run once before starting the server instead of in every worker
+    """
+    # Register all models on Base
+    import backend.models
+
+    Base.metadata.create_all(bind=bind)
+
+    # Let readers in other worker processes keep going while one of them writes
+    if bind.dialect.name == "sqlite":
+        with bind.connect() as connection:
+            connection.execute("PRAGMA journal_mode=WAL")
@@ -0,0 +1,260 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta
+
+from fastapi import HTTPException
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse
+from sqlalchemy.orm import Session
+
+from backend.crud import idempotency as idempotency_crud
+
+
+# Max number of responses kept in memory. Older ones are still served from the database
+IDEMPOTENCY_CACHE_SIZE = int(os.environ.get("IDEMPOTENCY_CACHE_SIZE", 10000))
+# Seconds a duplicate waits for the first request with its key before getting a 409
+IDEMPOTENCY_WAIT_SECONDS = float(os.environ.get("IDEMPOTENCY_WAIT_SECONDS", 10))
+# Max duplicates of one key that wait in a worker. Each one blocks a threadpool thread, so more get a 409 right away
+IDEMPOTENCY_MAX_WAITERS = int(os.environ.get("IDEMPOTENCY_MAX_WAITERS", 2))
+# Seconds after which a request that hasn't stored its response is presumed dead, and a retry may run it again
+IDEMPOTENCY_LEASE_SECONDS = float(os.environ.get("IDEMPOTENCY_LEASE_SECONDS", 60))
+# Hours a stored response is kept
+IDEMPOTENCY_TTL_HOURS = float(os.environ.get("IDEMPOTENCY_TTL_HOURS", 24))
+
+# Seconds between checks on a key claimed by another process
+POLL_SECONDS = 0.05
+# Seconds between removals of expired records
+CLEANUP_INTERVAL_SECONDS = 60
+
+
+class IdempotencyStore:
+    """
+    Remembers the response for each idempotency key, so retries get the same response without running again.
+    Responses live in an in-memory LRU, backed by the idempotency_records table.
+    A key is claimed in the table before its request runs, and the response is stored in the same commit
+    as the request's changes, so duplicates in other worker processes never run too.
+    Duplicates in the same process wait for the first one instead of polling the table, up to `max_waiters` per key.
+    """
+
+    def __init__(
+        self,
+        max_size: int = IDEMPOTENCY_CACHE_SIZE,
+        wait_seconds: float = IDEMPOTENCY_WAIT_SECONDS,
+        max_waiters: int = IDEMPOTENCY_MAX_WAITERS,
+        lease_seconds: float = IDEMPOTENCY_LEASE_SECONDS,
+        ttl_hours: float = IDEMPOTENCY_TTL_HOURS,
+    ):
+        self.max_size = max_size
+        self.wait_seconds = wait_seconds
+        self.max_waiters = max_waiters
+        self.lease = timedelta(seconds=lease_seconds)
+        self.ttl = timedelta(hours=ttl_hours)
+        self._cache = OrderedDict()
+        self._in_flight = {}
+        self._lock = threading.Lock()
+        self._last_cleanup = time.monotonic()
+        # Counters to see how much work retries actually cause
+        self.stats = {"executed": 0, "memory_hits": 0, "table_hits": 0, "coalesced": 0, "in_progress": 0}
+
+    def execute(self, db: Session, key: str, fingerprint: str, handler):
+        """
+        Return the stored response for the key, or run the handler and store its response.
+        The handler must not commit. HTTPExceptions raised by the handler are stored and replayed as well
+        """
+        deadline = time.monotonic() + self.wait_seconds
+
+        while True:
+            with self._lock:
+                cached = self._get_cached(key)
+                if cached is not None:
+                    self.stats["memory_hits"] += 1
+                    return self._replay(cached, fingerprint)
+
+                in_flight = self._in_flight.get(key)
+                if in_flight is None:
+                    self._in_flight[key] = {"done": threading.Event(), "waiters": 0}
+                    break
+
+                # Don't let a retry storm tie up every threadpool thread waiting on one key
+                if in_flight["waiters"] >= self.max_waiters:
+                    in_flight = None
+                else:
+                    in_flight["waiters"] += 1
+                    self.stats["coalesced"] += 1
+
+            if in_flight is None:
+                return self._in_progress()
+
+            # Another request with this key is running here, so wait for its response and check again
+            finished = in_flight["done"].wait(max(deadline - time.monotonic(), 0))
+            with self._lock:
+                in_flight["waiters"] -= 1
+            if not finished:
+                return self._in_progress()
+
+        try:
+            response = self._claim_and_run(db=db, key=key, fingerprint=fingerprint, handler=handler, deadline=deadline)
+        finally:
+            with self._lock:
+                self._in_flight.pop(key)["done"].set()
+
+        self._cleanup_if_due(db=db)
+        return response
+
+    def prime(self, db: Session):
+        """
+        Load the most recent stored responses into memory, so retries right after a restart skip the database
+        """
+        db_records = idempotency_crud.get_latest_records(db=db, limit=self.max_size, since=datetime.utcnow() - self.ttl)
+
+        with self._lock:
+            # Oldest first, so the newest end up as the most recently used
+            for db_record in reversed(db_records):
+                self._remember(db_record.key, self._stored(db_record))
+
+        return len(db_records)
+
+    def cleanup(self, db: Session):
+        """
+        Remove stored responses older than the TTL. Returns the number removed
+        """
+        return idempotency_crud.delete_records_older_than(db=db, cutoff=datetime.utcnow() - self.ttl)
+
+    def clear(self):
+        with self._lock:
+            self._cache.clear()
+
+    def _claim_and_run(self, db: Session, key: str, fingerprint: str, handler, deadline: float):
+        while True:
+            # Look the key up with a plain read first. Replays and waits never need the SQLite writer lock
+            db_record = idempotency_crud.get_record(db=db, key=key)
+
+            if db_record is None:
+                claimed_at = idempotency_crud.create_pending_record(db=db, key=key, fingerprint=fingerprint)
+                if claimed_at is not None:
+                    return self._run(db=db, key=key, fingerprint=fingerprint, claimed_at=claimed_at, handler=handler)
+                # Another process claimed the key in the meantime, so read it again
+                continue
+
+            if db_record.status_code is not None:
+                with self._lock:
+                    self.stats["table_hits"] += 1
+                    stored = self._stored(db_record)
+                    self._remember(key, stored)
+                return self._replay(stored, fingerprint)
+
+            if db_record.fingerprint != fingerprint:
+                return self._mismatch()
+
+            if datetime.utcnow() - db_record.claimed_at > self.lease:
+                claimed_at = idempotency_crud.take_over_record(db=db, key=key, seen_claimed_at=db_record.claimed_at)
+                if claimed_at is not None:
+                    return self._run(db=db, key=key, fingerprint=fingerprint, claimed_at=claimed_at, handler=handler)
+
+            # Another process is running the request, so read the key again until it's done or we run out of time
+            if time.monotonic() >= deadline:
+                return self._in_progress()
+            time.sleep(POLL_SECONDS)
+
+    def _run(self, db: Session, key: str, fingerprint: str, claimed_at: datetime, handler):
+        with self._lock:
+            self.stats["executed"] += 1
+
+        try:
+            status_code, content = 200, jsonable_encoder(handler())
+        except HTTPException as e:
+            # Throw away whatever the failed handler left in the session before storing the response
+            db.rollback()
+            status_code, content = e.status_code, {"detail": e.detail}
+        except Exception:
+            db.rollback()
+            idempotency_crud.delete_pending_record(db=db, key=key, claimed_at=claimed_at)
+            raise
+
+        # Store the response in the same commit as the handler's changes, so either both happen or neither does
+        if not idempotency_crud.complete_record(db=db, key=key, claimed_at=claimed_at, status_code=status_code, content=content):
+            # We took too long and a retry took over the key, so its changes count instead of ours
+            db.rollback()
+            return self._in_progress()
+        db.commit()
+
+        with self._lock:
+            self._remember(key, (fingerprint, status_code, content, claimed_at))
+
+        return self._response(status_code, content, replayed=False)
+
+    def _cleanup_if_due(self, db: Session):
+        with self._lock:
+            due = time.monotonic() - self._last_cleanup >= CLEANUP_INTERVAL_SECONDS
+            if due:
+                self._last_cleanup = time.monotonic()
+
+        if due:
+            self.cleanup(db=db)
+
+    def _get_cached(self, key: str):
+        if key not in self._cache:
+            return None
+
+        stored = self._cache[key]
+        if datetime.utcnow() - stored[3] > self.ttl:
+            del self._cache[key]
+            return None
+
+        self._cache.move_to_end(key)
+        return stored
+
+    def _remember(self, key: str, stored):
+        self._cache[key] = stored
+        self._cache.move_to_end(key)
+        while len(self._cache) > self.max_size:
+            self._cache.popitem(last=False)
+
+    @staticmethod
+    def _stored(db_record):
+        return db_record.fingerprint, db_record.status_code, json.loads(db_record.body), db_record.created_at
+
+    def _replay(self, stored, fingerprint: str):
+        stored_fingerprint, status_code, content, _ = stored
+
+        if stored_fingerprint != fingerprint:
+            return self._mismatch()
+
+        return self._response(status_code, content, replayed=True)
+
+    @staticmethod
+    def _mismatch():
+        return JSONResponse(status_code=422, content={"detail": "Idempotency-Key was already used for a different request"})
+
+    def _in_progress(self):
+        with self._lock:
+            self.stats["in_progress"] += 1
+
+        return JSONResponse(status_code=409, content={"detail": "A request with this Idempotency-Key is still in progress"})
+
+    @staticmethod
+    def _response(status_code: int, content, replayed: bool):
+        headers = {"Idempotent-Replayed": "true"} if replayed else None
+        return JSONResponse(status_code=status_code, content=content, headers=headers)
+
+
+idempotency_store = IdempotencyStore()
+
+
+def idempotency_scope(method: str, path: str, key: str):
+    """
+    Keys are only unique per route, so prefix them with the request method and path
+    """
+    return f"{method} {path} {key}"
+
+
+def request_fingerprint(method: str, path: str, query: dict, body: dict = None):
+    """
+    Hash of everything that makes up a request, to tell whether a retry is really the same request
+    """
+    payload = json.dumps({"method": method, "path": path, "query": query, "body": body}, sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode()).hexdigest()
@@ -1,4 +1,14 @@
+import os
+import sys
+
 import uvicorn
 
+# This file is run as a script, so make the backend package importable
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from backend.database.config import init_db
+
+# Dev server. Use backend/serve.py in production
 if __name__ == "__main__":
+    init_db()
     uvicorn.run("backend.app:app", host="0.0.0.0", port=8000, reload=True)
\ No newline at end of file
@@ -1,4 +1,7 @@
 # Import everything here for convenience in other modules
 
 from .user import *
-from .transaction import *
\ No newline at end of file
+from .transaction import *
+from .expiry import *
+from .idempotency import *
+from .payer import *
\ No newline at end of file
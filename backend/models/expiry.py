@@ -0,0 +1,21 @@
+from sqlalchemy import String, Integer, ForeignKey, Column, DateTime
+from uuid import uuid4
+from datetime import datetime
+
+from backend.database.config import Base
+
+
+class ExpiryPolicy(Base):
+    __tablename__ = "expiry_policies"
+    payer = Column(String, primary_key=True, index=True)
+    expire_after_days = Column(Integer, nullable=False)
+
+
+class ExpiryEvent(Base):
+    __tablename__ = "expiry_events"
+    id = Column(String, primary_key=True, index=True, default=lambda: str(uuid4()))
+    transaction_id = Column(String, ForeignKey("transactions.id"), nullable=False, index=True)
+    user_id = Column(String, ForeignKey("users.id"), nullable=False, index=True)
+    payer = Column(String, nullable=False)
+    points = Column(Integer, nullable=False)
+    expired_at = Column(DateTime, nullable=False, default=datetime.utcnow)
@@ -0,0 +1,17 @@
+from sqlalchemy import String, Integer, Column, DateTime, Text
+from datetime import datetime
+
+from backend.database.config import Base
+
+
+class IdempotencyRecord(Base):
+    __tablename__ = "idempotency_records"
+    key = Column(String, primary_key=True, index=True)
+    # Hash of the request, so a key reused for a different request can be rejected
+    fingerprint = Column(String, nullable=False)
+    # Both are empty while the first request with the key is still running
+    status_code = Column(Integer)
+    body = Column(Text)
+    # When the running request claimed the key. A retry can take over a claim that is too old
+    claimed_at = Column(DateTime, nullable=False, default=datetime.utcnow)
+    created_at = Column(DateTime, nullable=False, default=datetime.utcnow, index=True)
@@ -0,0 +1,19 @@
+from sqlalchemy import String, Integer, Column
+from sqlalchemy.ext.hybrid import hybrid_property
+
+from backend.database.config import Base
+
+
+class PayerLiability(Base):
+    """
+    Running totals of a payer's points across all users, kept up to date as the ledger changes
+    """
+    __tablename__ = "payer_liabilities"
+    payer = Column(String, primary_key=True, index=True)
+    issued_points = Column(Integer, nullable=False, default=0)
+    consumed_points = Column(Integer, nullable=False, default=0)
+    user_count = Column(Integer, nullable=False, default=0)
+
+    @hybrid_property
+    def outstanding_points(self):
+        return self.issued_points - self.consumed_points
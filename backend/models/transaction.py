@@ -1,4 +1,4 @@
-from sqlalchemy import String, Integer, ForeignKey, Column, DateTime
+from sqlalchemy import String, Integer, ForeignKey, Column, DateTime, Index, text
 from sqlalchemy.orm import relationship
 from sqlalchemy.ext.hybrid import hybrid_property
 from uuid import uuid4
@@ -8,6 +8,10 @@ from backend.database.config import Base
 
 class Transaction(Base):
     __tablename__ = "transactions"
+    # Lets the expiry sweeper find a payer's oldest lots with unused points, without scanning the used up ones
+    __table_args__ = (
+        Index("ix_transactions_unused_payer_date", "payer", "transaction_date", "id", sqlite_where=text("used_points < points")),
+    )
     id = Column(String, primary_key=True, index=True, default=lambda: str(uuid4()))
     points = Column(Integer, nullable=False)
     used_points = Column(Integer, nullable=False, default=0)
@@ -0,0 +1,62 @@
+from fastapi import APIRouter, Depends, HTTPException, Query
+from typing import List, Optional
+from sqlalchemy.orm import Session
+
+from backend.crud import expiry as expiry_crud
+from backend.schemas import ExpiryPolicyIn, ExpiryPolicyOut, ExpiryEventOut, SweepResult
+from backend.sweeper import sweeper, sweep_expired_points
+from backend import get_db
+
+
+router = APIRouter(prefix="/expiry", tags=["expiry"])
+
+
+@router.get("/policies", response_model=List[ExpiryPolicyOut])
+def get_policies(db: Session = Depends(get_db)):
+    """
+    Get all payer expiry policies
+    """
+    return expiry_crud.get_policies(db=db)
+
+
+@router.put("/policies/{payer}", response_model=ExpiryPolicyOut)
+def set_policy(payer: str, policy: ExpiryPolicyIn, db: Session = Depends(get_db)):
+    """
+    Create or replace the expiry policy of a payer
+    """
+    return expiry_crud.set_policy(db=db, payer=payer, policy=policy)
+
+
+@router.delete("/policies/{payer}")
+def delete_policy(payer: str, db: Session = Depends(get_db)):
+    """
+    Remove the expiry policy of a payer, so its points no longer expire
+    """
+    if not expiry_crud.delete_policy(db=db, payer=payer):
+        raise HTTPException(status_code=400, detail="Payer has no expiry policy")
+
+    return {"payer": payer}
+
+
+@router.get("/events", response_model=List[ExpiryEventOut])
+def get_expiry_events(user_id: Optional[str] = None, skip: int = 0, limit: int = 10, db: Session = Depends(get_db)):
+    """
+    Get recorded expiry events, newest first
+    """
+    return expiry_crud.get_expiry_events(db=db, user_id=user_id, skip=skip, limit=limit)
+
+
+@router.post("/sweep", response_model=SweepResult)
+def run_sweep(batch_size: int = Query(sweeper.batch_size, gt=0), db: Session = Depends(get_db)):
+    """
+    Expire aged points right away instead of waiting for the background sweeper
+    """
+    return sweep_expired_points(db=db, batch_size=batch_size)
+
+
+@router.get("/sweep", response_model=Optional[SweepResult])
+def get_last_sweep():
+    """
+    Get the stats of the last background sweep, if any has run
+    """
+    return sweeper.last_result
@@ -0,0 +1,41 @@
+import os
+
+from fastapi import APIRouter, Depends
+from fastapi.responses import JSONResponse
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.orm import Session
+
+from backend.warmup import state
+from backend import get_db
+
+
+router = APIRouter(prefix="/health", tags=["health"])
+
+
+@router.get("/live")
+def liveness():
+    """
+    The worker process is up and serving requests
+    """
+    return {"status": "alive", "pid": os.getpid()}
+
+
+@router.get("/ready")
+def readiness(db: Session = Depends(get_db)):
+    """
+    The worker has finished warming up and can reach the database
+    """
+    if not state["ready"]:
+        return JSONResponse(status_code=503, content={"status": "starting", "pid": os.getpid()})
+
+    try:
+        db.execute("SELECT 1")
+    except SQLAlchemyError:
+        return JSONResponse(status_code=503, content={"status": "database unavailable", "pid": os.getpid()})
+
+    return {
+        "status": "ready",
+        "pid": os.getpid(),
+        "cold_start_ms": state["cold_start_ms"],
+        "warm_up_ms": state["warm_up_ms"],
+    }
@@ -0,0 +1,39 @@
+from fastapi import APIRouter, Depends, HTTPException
+from typing import List
+from sqlalchemy.orm import Session
+
+from backend.crud import payer as payer_crud
+from backend.schemas import PayerLiabilityOut
+from backend import get_db
+
+
+router = APIRouter(prefix="/payers", tags=["payers"])
+
+
+@router.get("/", response_model=List[PayerLiabilityOut])
+def get_payer_liabilities(db: Session = Depends(get_db)):
+    """
+    Get outstanding, issued and consumed points and number of users of every payer, across all users
+    """
+    return payer_crud.get_payer_liabilities(db=db)
+
+
+@router.post("/recompute", response_model=List[PayerLiabilityOut])
+def recompute_payer_liabilities(db: Session = Depends(get_db)):
+    """
+    Rebuild the payer totals from scratch out of all transactions
+    """
+    return payer_crud.recompute_payer_liabilities(db=db)
+
+
+@router.get("/{payer}", response_model=PayerLiabilityOut)
+def get_payer_liability(payer: str, db: Session = Depends(get_db)):
+    """
+    Get outstanding, issued and consumed points and number of users of a specific payer, across all users
+    """
+    db_liability = payer_crud.get_payer_liability(db=db, payer=payer)
+
+    if not db_liability:
+        raise HTTPException(status_code=400, detail="Payer does not exist")
+
+    return db_liability
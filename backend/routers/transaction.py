@@ -1,11 +1,13 @@
-from fastapi import APIRouter, Depends, HTTPException
-from typing import List
+from fastapi import APIRouter, Depends, HTTPException, Header, Request
+from typing import List, Optional
 from sqlalchemy.orm import Session
 from datetime import timezone
 
 from backend.crud import transaction as trans_crud
 from backend.crud import user as user_crud
+from backend.crud import payer as payer_crud
 from backend.schemas import TransactionIn, TransactionOut
+from backend.idempotency import idempotency_store, idempotency_scope, request_fingerprint
 from backend import get_db
 
 
@@ -26,9 +28,24 @@ def get_transactions(user_id: str, skip: int = 0, limit: int = 10, db: Session =
 
 
 @router.post("/{user_id}", response_model=TransactionOut)
-def create_transaction(user_id: str, transaction: TransactionIn, db: Session = Depends(get_db)):
+def create_transaction(request: Request, user_id: str, transaction: TransactionIn, idempotency_key: Optional[str] = Header(None), db: Session = Depends(get_db)):
     """
-    Route to create a new transaction
+    Route to create a new transaction. Retries with the same Idempotency-Key header get the original response
+    """
+    if idempotency_key:
+        key = idempotency_scope(request.method, request.url.path, idempotency_key)
+        # Leave out defaults like the generated transaction_date, so a retry matches the original request
+        fingerprint = request_fingerprint(request.method, request.url.path, dict(request.query_params), transaction.dict(exclude_unset=True))
+        return idempotency_store.execute(db=db, key=key, fingerprint=fingerprint, handler=lambda: _create_transaction(user_id, transaction, db))
+
+    response = _create_transaction(user_id, transaction, db)
+    db.commit()
+    return response
+
+
+def _create_transaction(user_id: str, transaction: TransactionIn, db: Session):
+    """
+    Create the transaction without committing it
     """
     db_user = user_crud.get_user(db=db, user_id=user_id)
 
@@ -48,32 +65,46 @@ def create_transaction(user_id: str, transaction: TransactionIn, db: Session = D
         last_transaction_time = last_transaction_time.replace(tzinfo=timezone.utc)
         if transaction.transaction_date < last_transaction_time:
             raise HTTPException(status_code=400, detail="New transactions must occur after the last recorded transaction")
-    
+
     new_transaction = trans_crud.create_transaction(db=db, transaction=transaction, user_id=user_id)
 
+    # Update the payer totals in the same commit as the new transaction. A negative transaction consumes points it reduces below.
+    # The insert above holds the write lock, so two first transactions of a payer can't both count the user
+    is_new_user_of_payer = not trans_crud.user_has_other_transactions_of_payer(db=db, user_id=user_id, payer=transaction.payer, transaction_id=new_transaction.id)
+    payer_crud.add_to_payer_liability(
+        db=db,
+        payer=transaction.payer,
+        issued=max(transaction.points, 0),
+        consumed=max(-transaction.points, 0),
+        users=int(is_new_user_of_payer),
+    )
+
     # If the added transaction has negative points, take off points from the oldest entries of the same payer
     if new_transaction.points < 0:
-        # Get all transactions from this payer with positive points
+        # Get all transactions from this payer with positive points. The insert above holds the write lock,
+        # so these can't change before the commit, but some may have expired since the balance check
         payer_transactions = trans_crud.get_all_active_transactions_of_payer(db=db, user_id=user_id, payer=new_transaction.payer)
         to_reduce = abs(new_transaction.points)
 
         # Reduce transactions until to_reduce is 0
         for transaction in payer_transactions:
-            # If can use all points, do so
-            if transaction.usable_points >= to_reduce:
-                transaction.used_points += to_reduce
+            # If can use all points, do so. If not, reduce from current transaction and calc what's left
+            to_use = min(transaction.usable_points, to_reduce)
+
+            if not trans_crud.use_points(db=db, transaction=transaction, points=to_use):
+                raise HTTPException(status_code=409, detail="Points changed while applying the transaction, please try again")
+
+            to_reduce -= to_use
+            if to_reduce == 0:
                 break
-            # If not, reduce from current transaction and calc what's left
-            else:
-                to_use = transaction.usable_points
-                transaction.used_points += to_use
-                to_reduce -= to_use
+
+        if to_reduce > 0:
+            raise HTTPException(status_code=400, detail="Invalid transaction with negative points: amount exceeds current balance for this payer")
 
         # Mark the transaction as used
         new_transaction.used_points = new_transaction.points
 
-        db.commit()
-        db.refresh(new_transaction)
+        db.flush()
     
-    return new_transaction
+    return TransactionOut.from_orm(new_transaction)
 
@@ -1,17 +1,22 @@
 from collections import defaultdict
 
-from fastapi import APIRouter, Depends, HTTPException, Query
-from typing import List
+from fastapi import APIRouter, Depends, HTTPException, Query, Header, Request
+from typing import List, Optional
 from sqlalchemy.orm import Session
 
 from backend.crud import user as user_crud
 from backend.crud import transaction as trans_crud
+from backend.crud import payer as payer_crud
 from backend.schemas import UserIn, UserOut
+from backend.idempotency import idempotency_store, idempotency_scope, request_fingerprint
 from backend import get_db
 
 
 router = APIRouter(prefix="/users", tags=["users"])
 
+# Times a deduct is retried when its points change between reading and writing them
+DEDUCT_ATTEMPTS = 3
+
 
 @router.post("/", response_model=UserOut)
 def create_user(user: UserIn, db: Session = Depends(get_db)):
@@ -68,16 +73,47 @@ def get_points_balance(user_id: str, db: Session = Depends(get_db)):
 
 
 @router.post("/{user_id}/deduct")
-def deduct_points_from_balance(user_id: str, deduct_amount: int = Query(..., gt=0), db: Session = Depends(get_db)):
+def deduct_points_from_balance(request: Request, user_id: str, deduct_amount: int = Query(..., gt=0), idempotency_key: Optional[str] = Header(None), db: Session = Depends(get_db)):
     """
-    Deduct points from transactions with unused positive points, from oldest to latest
+    Deduct points from transactions with unused positive points, from oldest to latest.
+    Retries with the same Idempotency-Key header get the original response
+    """
+    if idempotency_key:
+        key = idempotency_scope(request.method, request.url.path, idempotency_key)
+        fingerprint = request_fingerprint(request.method, request.url.path, dict(request.query_params))
+        return idempotency_store.execute(db=db, key=key, fingerprint=fingerprint, handler=lambda: _deduct_points_from_balance(user_id, deduct_amount, db))
+
+    response = _deduct_points_from_balance(user_id, deduct_amount, db)
+    db.commit()
+    return response
+
+
+def _deduct_points_from_balance(user_id: str, deduct_amount: int, db: Session):
+    """
+    Deduct the points without committing
     """
     db_user = user_crud.get_user(db=db, user_id=user_id)
 
     if not db_user:
         raise HTTPException(status_code=400, detail="User does not exist")
-    
+
+    for _ in range(DEDUCT_ATTEMPTS):
+        response = _try_deduct_points(user_id, deduct_amount, db)
+        if response is not None:
+            return response
+
+        # Some points were used by someone else, e.g. the expiry sweeper, between reading and writing them. Start over
+        db.rollback()
+
+    raise HTTPException(status_code=409, detail="Points changed while deducting, please try again")
+
+
+def _try_deduct_points(user_id: str, deduct_amount: int, db: Session):
+    """
+    Deduct the points without committing. Returns None if any of the transactions changed since they were read
+    """
     response = defaultdict(int)
+    to_use = []
 
     # Get all applicable transactions for this user
     active_transactions = trans_crud.get_all_active_transactions(db=db, user_id=user_id)
@@ -88,12 +124,12 @@ def deduct_points_from_balance(user_id: str, deduct_amount: int = Query(..., gt=
 
         # If there is still anything left to deduct, that means we used all of the available points for this transaction
         if amount_left > 0:
-            transaction.used_points += usable_points
+            to_use.append((transaction, usable_points))
             response[payer] -= usable_points
 
         # If there is nothing left (or negative), this means the amount we used is equal to deduct_amount
         else:
-            transaction.used_points += deduct_amount
+            to_use.append((transaction, deduct_amount))
             response[payer] -= deduct_amount
         
         deduct_amount = amount_left
@@ -106,6 +142,13 @@ def deduct_points_from_balance(user_id: str, deduct_amount: int = Query(..., gt=
     if deduct_amount > 0:
         raise HTTPException(status_code=400, detail="The user does not have enough points to deduct this amount")
 
-    # Changes were valid, so commit
-    db.commit()
+    # Only write if nobody used these points since we read them
+    for transaction, points in to_use:
+        if not trans_crud.use_points(db=db, transaction=transaction, points=points):
+            return None
+
+    for payer, points in response.items():
+        payer_crud.add_to_payer_liability(db=db, payer=payer, consumed=-points)
+
+    # Changes were valid, the caller commits them
     return response
\ No newline at end of file
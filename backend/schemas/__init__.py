@@ -1,2 +1,4 @@
 from .user import *
-from .transaction import *
\ No newline at end of file
+from .transaction import *
+from .expiry import *
+from .payer import *
\ No newline at end of file
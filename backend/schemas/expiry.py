@@ -0,0 +1,39 @@
+from pydantic import BaseModel, Field
+from datetime import datetime
+
+
+class ExpiryPolicyBase(BaseModel):
+    expire_after_days: int = Field(..., gt=0)
+
+
+class ExpiryPolicyIn(ExpiryPolicyBase):
+    pass
+
+
+class ExpiryPolicyOut(ExpiryPolicyBase):
+    payer: str
+
+    class Config:
+        orm_mode = True
+
+
+class ExpiryEventOut(BaseModel):
+    id: str
+    transaction_id: str
+    user_id: str
+    payer: str
+    points: int
+    expired_at: datetime
+
+    class Config:
+        orm_mode = True
+
+
+class SweepResult(BaseModel):
+    lots_expired: int = 0
+    points_expired: int = 0
+    batches: int = 0
+    elapsed_seconds: float = 0.0
+    lots_per_second: float = 0.0
+    max_lock_hold_ms: float = 0.0
+    mean_lock_hold_ms: float = 0.0
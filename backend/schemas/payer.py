@@ -0,0 +1,12 @@
+from pydantic import BaseModel
+
+
+class PayerLiabilityOut(BaseModel):
+    payer: str
+    outstanding_points: int
+    issued_points: int
+    consumed_points: int
+    user_count: int
+
+    class Config:
+        orm_mode = True
@@ -0,0 +1,56 @@
+import argparse
+import os
+
+import uvicorn
+
+from backend.database.config import init_db
+from backend.sweeper import sweeper
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Run the points backend in production")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument(
+        "--workers", type=int, default=int(os.environ.get("WEB_CONCURRENCY", os.cpu_count() or 1)),
+        help="Number of worker processes. Defaults to $WEB_CONCURRENCY, or the number of cores",
+    )
+    parser.add_argument("--access-log", action="store_true", help="Log every request. Off by default as it costs throughput")
+    parser.add_argument("--skip-init", action="store_true", help="Don't set up the schema, e.g. when it was done by an earlier deploy step")
+    parser.add_argument("--init-only", action="store_true", help="Set up the schema and exit without starting the server")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+
+    # Set up the schema once here, before any worker starts
+    if not args.skip_init:
+        init_db()
+
+    if args.init_only:
+        return
+
+    # Run the background sweeper once in this process, instead of one per worker sweeping the same lots.
+    # The workers inherit the environment, so turn it off for them. A single worker runs in this process
+    # and starts this same sweeper from the app's startup event
+    if sweeper.interval > 0 and args.workers > 1:
+        sweeper.start()
+        os.environ["EXPIRY_SWEEP_INTERVAL_SECONDS"] = "0"
+
+    try:
+        uvicorn.run(
+            "backend.app:app",
+            host=args.host,
+            port=args.port,
+            workers=args.workers,
+            loop="uvloop",
+            http="httptools",
+            access_log=args.access_log,
+        )
+    finally:
+        sweeper.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,122 @@
+import logging
+import os
+import threading
+import time
+from datetime import datetime, timedelta
+
+from sqlalchemy.orm import Session
+
+from backend.crud import expiry as expiry_crud
+from backend.database.config import SessionLocal
+from backend.schemas import SweepResult
+
+
+logger = logging.getLogger(__name__)
+
+# Seconds between background sweeps. 0 disables the background sweeper.
+SWEEP_INTERVAL_SECONDS = float(os.environ.get("EXPIRY_SWEEP_INTERVAL_SECONDS", 0))
+# Max number of lots expired per write transaction, which bounds how long the SQLite writer lock is held
+SWEEP_BATCH_SIZE = int(os.environ.get("EXPIRY_SWEEP_BATCH_SIZE", 500))
+
+
+def sweep_expired_points(db: Session, batch_size: int = SWEEP_BATCH_SIZE, now: datetime = None):
+    """
+    Expire all lots older than their payer's policy allows, committing every `batch_size` lots
+    """
+    # Dates are stored as naive UTC
+    now = now or datetime.utcnow()
+    result = SweepResult()
+    lock_holds = []
+    start = time.perf_counter()
+
+    for policy in expiry_crud.get_policies(db=db):
+        cutoff = now - timedelta(days=policy.expire_after_days)
+
+        after = None
+
+        while True:
+            batch = expiry_crud.get_expirable_transactions(db=db, payer=policy.payer, cutoff=cutoff, limit=batch_size, after=after)
+
+            if not batch:
+                db.rollback()
+                break
+
+            # The batch was read without the lock, which is only held from the first write to the commit
+            lock_start = time.perf_counter()
+            events = expiry_crud.expire_transactions(db=db, transactions=batch, expired_at=now)
+
+            if events is None:
+                # Some lots changed while we read them, so read the same batch again
+                db.rollback()
+                continue
+
+            db.commit()
+            lock_holds.append(time.perf_counter() - lock_start)
+
+            result.lots_expired += len(events)
+            result.points_expired += sum(event["points"] for event in events)
+            result.batches += 1
+
+            # A short batch means there is nothing left for this payer
+            if len(batch) < batch_size:
+                break
+
+            # Carry on after the last lot of this batch instead of reading the used up lots again
+            after = (batch[-1].transaction_date, batch[-1].id)
+
+    result.elapsed_seconds = time.perf_counter() - start
+    if result.elapsed_seconds > 0:
+        result.lots_per_second = result.lots_expired / result.elapsed_seconds
+    if lock_holds:
+        result.max_lock_hold_ms = max(lock_holds) * 1000
+        result.mean_lock_hold_ms = sum(lock_holds) / len(lock_holds) * 1000
+
+    return result
+
+
+class ExpirySweeper:
+    """
+    Runs `sweep_expired_points` on a background thread every `interval` seconds
+    """
+
+    def __init__(self, interval: float = SWEEP_INTERVAL_SECONDS, batch_size: int = SWEEP_BATCH_SIZE, session_factory=SessionLocal):
+        self.interval = interval
+        self.batch_size = batch_size
+        self.session_factory = session_factory
+        self.last_result = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="expiry-sweeper", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        if self._thread is None:
+            return
+        self._stop.set()
+        self._thread.join()
+        self._thread = None
+
+    def run_once(self):
+        db = self.session_factory()
+        try:
+            self.last_result = sweep_expired_points(db=db, batch_size=self.batch_size)
+        finally:
+            db.close()
+
+        logger.info("Expiry sweep: %s", self.last_result)
+        return self.last_result
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.run_once()
+            except Exception:
+                logger.exception("Expiry sweep failed")
+
+
+sweeper = ExpirySweeper()
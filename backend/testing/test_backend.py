@@ -2,11 +2,23 @@ from fastapi.testclient import TestClient
 from sqlalchemy import create_engine
 from sqlalchemy.orm import sessionmaker
 import pytest
+import sqlite3
+import threading
+import time
+from datetime import datetime
 
 from backend import get_db
 from backend.app import app
 from backend.database.config import Base
 from backend.models.user import User
+from backend.crud import expiry as expiry_crud
+from backend.crud import idempotency as idempotency_crud
+from backend.crud import transaction as trans_crud
+from backend.routers.user import _deduct_points_from_balance
+from backend.sweeper import sweep_expired_points
+from backend.idempotency import IdempotencyStore
+from backend.idempotency import idempotency_store
+from backend.warmup import warm_up, state as worker_state
 
 
 SQLALCHEMY_DATABASE_URL = "sqlite:///./test.db"
@@ -350,4 +362,493 @@ def test_deduct_oldest_first(db):
     transactions = client.get(f"/transactions/{user['id']}").json()
 
     assert transactions[0]["used_points"] == 300  # use Dannon's 100 first, note that 200 is already applied from the last transaction
-    assert transactions[1]["used_points"] == 200  # use Unilever's 200 second
\ No newline at end of file
+    assert transactions[1]["used_points"] == 200  # use Unilever's 200 second
+
+def assert_payer_totals_match_recompute(payer):
+    liability = client.get(f"/payers/{payer}").json()
+    recomputed = {l["payer"]: l for l in client.post("/payers/recompute").json()}
+
+    assert liability == recomputed[payer]
+    assert liability["outstanding_points"] >= 0
+
+
+# -------- Expiry tests ---------------
+def test_sweep_expires_aged_points(db):
+    user = client.post("/users/", json={"name": "Hung", "email":"hung@mail.com"}).json()
+    new_transactions = [
+        {
+            "payer": "DANNON",
+            "points": 300,
+            "transaction_date": "2019-01-01T00:00:00.000Z"
+        },
+        {
+            "payer": "UNILEVER",
+            "points": 200,
+            "transaction_date": "2019-01-02T00:00:00.000Z"
+        },
+        {
+            "payer": "DANNON",
+            "points": -100,
+            "transaction_date": "2019-01-03T00:00:00.000Z"
+        },
+        {
+            "payer": "DANNON",
+            "points": 1000,
+        }
+    ]
+    for t in new_transactions:
+        client.post(f"/transactions/{user['id']}", json=t)
+
+    client.put("/expiry/policies/DANNON", json={"expire_after_days": 365})
+
+    # Use a batch size of 1 so the sweep has to commit in several batches
+    result = client.post("/expiry/sweep", params={"batch_size": 1}).json()
+
+    assert result["lots_expired"] == 1
+    assert result["points_expired"] == 200
+
+    # UNILEVER has no policy and the recent DANNON lot is not old enough
+    balance = client.get(f"/users/{user['id']}/balance").json()
+
+    assert balance == {
+        "DANNON": 1000,
+        "UNILEVER": 200
+    }
+
+    events = client.get("/expiry/events", params={"user_id": user["id"]}).json()
+
+    assert len(events) == 1
+    assert events[0]["payer"] == "DANNON"
+    assert events[0]["points"] == 200
+
+    # Expired lots are no longer active, so a second sweep has nothing to do
+    result = client.post("/expiry/sweep").json()
+
+    assert result["lots_expired"] == 0
+
+
+def test_sweep_commits_in_bounded_batches(db):
+    user = client.post("/users/", json={"name": "Hung", "email":"hung@mail.com"}).json()
+    for day in range(1, 6):
+        client.post(f"/transactions/{user['id']}", json={
+            "payer": "DANNON",
+            "points": 100,
+            "transaction_date": f"2019-01-0{day}T00:00:00.000Z"
+        })
+
+    client.put("/expiry/policies/DANNON", json={"expire_after_days": 30})
+    result = client.post("/expiry/sweep", params={"batch_size": 2}).json()
+
+    assert result["lots_expired"] == 5
+    assert result["points_expired"] == 500
+    assert result["batches"] == 3
+    assert result["max_lock_hold_ms"] >= result["mean_lock_hold_ms"] > 0
+
+    # Nothing is left to deduct
+    res = client.post(f"/users/{user['id']}/deduct", params={"deduct_amount": 1})
+
+    assert res.status_code == 400
+
+
+
+def test_sweep_skips_lots_deducted_while_sweeping(db):
+    user = client.post("/users/", json={"name": "Hung", "email":"hung@mail.com"}).json()
+    client.post(f"/transactions/{user['id']}", json={
+        "payer": "DANNON",
+        "points": 300,
+        "transaction_date": "2019-01-01T00:00:00.000Z"
+    })
+
+    # The sweeper reads the lot, then a deduct commits before the sweeper writes
+    batch = expiry_crud.get_expirable_transactions(db=db, payer="DANNON", cutoff=datetime(2020, 1, 1), limit=10)
+    client.post(f"/users/{user['id']}/deduct", params={"deduct_amount": 100})
+    events = expiry_crud.expire_transactions(db=db, transactions=batch, expired_at=datetime(2020, 1, 1))
+    db.rollback()
+
+    # The batch changed since it was read, so nothing is expired
+    assert events is None
+
+    # The next sweep reads the lot again and only expires what the deduct left
+    client.put("/expiry/policies/DANNON", json={"expire_after_days": 30})
+    result = client.post("/expiry/sweep").json()
+
+    assert result["lots_expired"] == 1
+    assert result["points_expired"] == 200
+
+    events = client.get("/expiry/events", params={"user_id": user["id"]}).json()
+
+    assert [event["points"] for event in events] == [200]
+    assert client.get(f"/users/{user['id']}/balance").json() == {"DANNON": 0}
+
+    # The deduct and the expiry are each counted once in the payer totals
+    liability = client.get("/payers/DANNON").json()
+
+    assert liability["issued_points"] == 300
+    assert liability["consumed_points"] == 300
+    assert liability["outstanding_points"] == 0
+    assert_payer_totals_match_recompute("DANNON")
+
+
+def test_deduct_retries_when_lots_expire_while_deducting(db, monkeypatch):
+    user = client.post("/users/", json={"name": "Hung", "email":"hung@mail.com"}).json()
+    client.post(f"/transactions/{user['id']}", json={
+        "payer": "DANNON",
+        "points": 300,
+        "transaction_date": "2019-01-01T00:00:00.000Z"
+    })
+    client.post(f"/transactions/{user['id']}", json={"payer": "DANNON", "points": 500})
+    client.put("/expiry/policies/DANNON", json={"expire_after_days": 30})
+
+    get_all_active_transactions = trans_crud.get_all_active_transactions
+    reads = []
+
+    def read_then_sweep(db, user_id):
+        transactions = get_all_active_transactions(db=db, user_id=user_id)
+        reads.append(1)
+
+        # The sweeper commits after the deduct read the old lot but before it writes
+        if len(reads) == 1:
+            sweeper_db = TestingSessionLocal()
+            try:
+                sweep_expired_points(db=sweeper_db)
+            finally:
+                sweeper_db.close()
+
+        return transactions
+
+    monkeypatch.setattr(trans_crud, "get_all_active_transactions", read_then_sweep)
+    result = client.post(f"/users/{user['id']}/deduct", params={"deduct_amount": 100}).json()
+
+    # The deduct read again and used the points that didn't expire
+    assert len(reads) == 2
+    assert result == {"DANNON": -100}
+
+    transactions = client.get(f"/transactions/{user['id']}").json()
+
+    assert [t["used_points"] for t in transactions] == [300, 100]
+
+    events = client.get("/expiry/events", params={"user_id": user["id"]}).json()
+
+    assert [event["points"] for event in events] == [300]
+
+    liability = client.get("/payers/DANNON").json()
+
+    assert liability["issued_points"] == 800
+    assert liability["consumed_points"] == 400
+    assert liability["outstanding_points"] == 400
+    assert_payer_totals_match_recompute("DANNON")
+
+# -------- Idempotency tests ---------------
+def test_deduct_retry_with_idempotency_key_applies_once(db):
+    user = client.post("/users/", json={"name": "Hung", "email":"hung@mail.com"}).json()
+    client.post(f"/transactions/{user['id']}", json={"payer": "DANNON", "points": 1000})
+
+    headers = {"Idempotency-Key": "deduct-1"}
+    first = client.post(f"/users/{user['id']}/deduct", params={"deduct_amount": 300}, headers=headers)
+    retry = client.post(f"/users/{user['id']}/deduct", params={"deduct_amount": 300}, headers=headers)
+
+    assert first.json() == retry.json() == {"DANNON": -300}
+    assert retry.headers["Idempotent-Replayed"] == "true"
+
+    balance = client.get(f"/users/{user['id']}/balance").json()
+
+    assert balance == {"DANNON": 700}
+
+
+def test_transaction_retry_with_idempotency_key_creates_once(db):
+    user = client.post("/users/", json={"name": "Hung", "email":"hung@mail.com"}).json()
+
+    headers = {"Idempotency-Key": "transaction-1"}
+    first = client.post(f"/transactions/{user['id']}", json={"payer": "DANNON", "points": 300}, headers=headers)
+    retry = client.post(f"/transactions/{user['id']}", json={"payer": "DANNON", "points": 300}, headers=headers)
+
+    assert first.json() == retry.json()
+
+    transactions = client.get(f"/transactions/{user['id']}").json()
+
+    assert len(transactions) == 1
+
+
+def test_failed_request_is_replayed_without_side_effects(db):
+    user = client.post("/users/", json={"name": "Hung", "email":"hung@mail.com"}).json()
+    client.post(f"/transactions/{user['id']}", json={"payer": "DANNON", "points": 100})
+    client.post(f"/transactions/{user['id']}", json={"payer": "COORS", "points": 100})
+
+    headers = {"Idempotency-Key": "deduct-too-much"}
+    first = client.post(f"/users/{user['id']}/deduct", params={"deduct_amount": 500}, headers=headers)
+    retry = client.post(f"/users/{user['id']}/deduct", params={"deduct_amount": 500}, headers=headers)
+
+    assert first.status_code == retry.status_code == 400
+    assert first.json() == retry.json()
+
+    # The points touched before the deduction failed must not be committed with the stored response
+    balance = client.get(f"/users/{user['id']}/balance").json()
+
+    assert balance == {"DANNON": 100, "COORS": 100}
+
+
+def test_stored_response_survives_memory_eviction(db):
+    store = IdempotencyStore(max_size=1)
+    calls = []
+
+    def handler():
+        calls.append(1)
+        return {"ok": len(calls)}
+
+    store.execute(db=db, key="a", fingerprint="a", handler=handler)
+    store.execute(db=db, key="b", fingerprint="b", handler=handler)
+    response = store.execute(db=db, key="a", fingerprint="a", handler=handler)
+
+    assert len(calls) == 2
+    assert response.body == b'{"ok":1}'
+    assert store.stats["table_hits"] == 1
+
+
+def test_concurrent_duplicates_are_coalesced(db):
+    store = IdempotencyStore(max_waiters=4)
+    calls = []
+
+    def handler():
+        calls.append(1)
+        time.sleep(0.2)
+        return {"ok": True}
+
+    def send():
+        session = TestingSessionLocal()
+        try:
+            store.execute(db=session, key="same", fingerprint="same", handler=handler)
+        finally:
+            session.close()
+
+    threads = [threading.Thread(target=send) for _ in range(5)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(calls) == 1
+    assert store.stats["executed"] == 1
+    assert store.stats["memory_hits"] == 4
+
+
+
+
+def test_waiting_duplicates_are_capped(db):
+    store = IdempotencyStore(max_waiters=1)
+    started, release = threading.Event(), threading.Event()
+
+    def handler():
+        started.set()
+        release.wait()
+        return {"ok": True}
+
+    def send(responses):
+        session = TestingSessionLocal()
+        try:
+            responses.append(store.execute(db=session, key="a", fingerprint="a", handler=handler))
+        finally:
+            session.close()
+
+    first_responses, waiter_responses = [], []
+    first = threading.Thread(target=send, args=(first_responses,))
+    first.start()
+    started.wait()
+    waiter = threading.Thread(target=send, args=(waiter_responses,))
+    waiter.start()
+
+    # Wait until the second request is blocked on the first one
+    while store.stats["coalesced"] < 1:
+        time.sleep(0.01)
+
+    # The waiter slot for the key is taken, so this duplicate doesn't block
+    response = store.execute(db=db, key="a", fingerprint="a", handler=handler)
+    release.set()
+    first.join()
+    waiter.join()
+
+    assert response.status_code == 409
+    assert first_responses[0].status_code == waiter_responses[0].status_code == 200
+
+
+def test_replay_from_table_does_not_need_the_write_lock(db):
+    IdempotencyStore().execute(db=db, key="a", fingerprint="a", handler=lambda: {"ok": True})
+
+    # Another connection holds the SQLite write lock while a different worker gets the retry
+    lock_holder = sqlite3.connect("./test.db", isolation_level=None)
+    lock_holder.execute("BEGIN IMMEDIATE")
+    try:
+        response = IdempotencyStore().execute(db=db, key="a", fingerprint="a", handler=lambda: {"ok": False})
+    finally:
+        lock_holder.execute("ROLLBACK")
+        lock_holder.close()
+
+    assert response.status_code == 200
+    assert response.body == b'{"ok":true}'
+
+def test_reused_key_with_different_request_is_rejected(db):
+    user = client.post("/users/", json={"name": "Hung", "email":"hung@mail.com"}).json()
+    client.post(f"/transactions/{user['id']}", json={"payer": "DANNON", "points": 1000})
+
+    headers = {"Idempotency-Key": "deduct-1"}
+    client.post(f"/users/{user['id']}/deduct", params={"deduct_amount": 10}, headers=headers)
+    response = client.post(f"/users/{user['id']}/deduct", params={"deduct_amount": 900}, headers=headers)
+
+    assert response.status_code == 422
+    assert client.get(f"/users/{user['id']}/balance").json() == {"DANNON": 990}
+
+
+def test_key_claimed_by_another_process_is_not_run(db):
+    store = IdempotencyStore(wait_seconds=0.2)
+    calls = []
+
+    # Another worker process claimed the key and is still running the request
+    idempotency_crud.create_pending_record(db=db, key="a", fingerprint="a")
+    response = store.execute(db=db, key="a", fingerprint="a", handler=lambda: calls.append(1))
+
+    assert response.status_code == 409
+    assert calls == []
+
+
+def test_key_of_dead_request_is_taken_over(db):
+    store = IdempotencyStore(lease_seconds=0)
+    idempotency_crud.create_pending_record(db=db, key="a", fingerprint="a")
+
+    response = store.execute(db=db, key="a", fingerprint="a", handler=lambda: {"ok": True})
+
+    assert response.status_code == 200
+    assert idempotency_crud.get_record(db=db, key="a").status_code == 200
+
+
+def test_crashed_request_changes_nothing_and_releases_key(db):
+    user = client.post("/users/", json={"name": "Hung", "email":"hung@mail.com"}).json()
+    client.post(f"/transactions/{user['id']}", json={"payer": "DANNON", "points": 1000})
+    store = IdempotencyStore()
+
+    def handler():
+        # Points are deducted, then the request crashes before its response is stored
+        _deduct_points_from_balance(user["id"], 100, db)
+        raise RuntimeError("crash")
+
+    with pytest.raises(RuntimeError):
+        store.execute(db=db, key="a", fingerprint="a", handler=handler)
+
+    # Nothing was committed, and a retry can run the request
+    assert client.get(f"/users/{user['id']}/balance").json() == {"DANNON": 1000}
+    assert idempotency_crud.get_record(db=db, key="a") is None
+
+
+def test_waiting_duplicate_times_out(db):
+    store = IdempotencyStore(wait_seconds=0.1)
+    started = threading.Event()
+
+    def handler():
+        started.set()
+        time.sleep(0.5)
+        return {"ok": True}
+
+    def send():
+        session = TestingSessionLocal()
+        try:
+            store.execute(db=session, key="a", fingerprint="a", handler=handler)
+        finally:
+            session.close()
+
+    first = threading.Thread(target=send)
+    first.start()
+    started.wait()
+    response = store.execute(db=db, key="a", fingerprint="a", handler=handler)
+    first.join()
+
+    assert response.status_code == 409
+
+
+def test_expired_responses_are_cleaned_up(db):
+    store = IdempotencyStore(ttl_hours=0)
+    store.execute(db=db, key="a", fingerprint="a", handler=lambda: {"ok": True})
+
+    assert store.cleanup(db=db) == 1
+    assert idempotency_crud.get_record(db=db, key="a") is None
+
+# -------- Payer liability tests ---------------
+def test_payer_liabilities_across_users(db):
+    hung = client.post("/users/", json={"name": "Hung", "email":"hung@mail.com"}).json()
+    other = client.post("/users/", json={"name": "Other", "email":"other@mail.com"}).json()
+    new_transactions = [
+        (hung, {"payer": "DANNON", "points": 300}),
+        (hung, {"payer": "UNILEVER", "points": 200}),
+        (hung, {"payer": "DANNON", "points": -200}),
+        (hung, {"payer": "DANNON", "points": 1000}),
+        (other, {"payer": "DANNON", "points": 500}),
+        # Rejected, so it must not show up in the totals
+        (other, {"payer": "UNILEVER", "points": -100}),
+    ]
+    for user, t in new_transactions:
+        client.post(f"/transactions/{user['id']}", json=t)
+
+    client.post(f"/users/{hung['id']}/deduct", params={"deduct_amount": 400})
+
+    liabilities = client.get("/payers/").json()
+
+    assert liabilities == [
+        {"payer": "DANNON", "outstanding_points": 1400, "issued_points": 1800, "consumed_points": 400, "user_count": 2},
+        {"payer": "UNILEVER", "outstanding_points": 0, "issued_points": 200, "consumed_points": 200, "user_count": 1},
+    ]
+
+    # The incremental totals match the balances of all users
+    hung_balance = client.get(f"/users/{hung['id']}/balance").json()
+    other_balance = client.get(f"/users/{other['id']}/balance").json()
+
+    assert hung_balance["DANNON"] + other_balance["DANNON"] == 1400
+
+    # A full recompute from the transactions gives the same totals
+    assert client.post("/payers/recompute").json() == liabilities
+
+
+def test_payer_liability_counts_expired_points_as_consumed(db):
+    user = client.post("/users/", json={"name": "Hung", "email":"hung@mail.com"}).json()
+    client.post(f"/transactions/{user['id']}", json={
+        "payer": "DANNON",
+        "points": 300,
+        "transaction_date": "2019-01-01T00:00:00.000Z"
+    })
+    client.put("/expiry/policies/DANNON", json={"expire_after_days": 30})
+    client.post("/expiry/sweep")
+
+    liability = client.get("/payers/DANNON").json()
+
+    assert liability["outstanding_points"] == 0
+    assert liability["consumed_points"] == 300
+    assert client.get("/payers/COORS").status_code == 400
+
+
+# -------- Health tests ---------------
+@pytest.fixture
+def cold_worker():
+    # warm_up changes module-level state, so start from a cold worker and put it back afterwards
+    initial_state = dict(worker_state)
+    worker_state.update(ready=False, cold_start_ms=None, warm_up_ms=None)
+    idempotency_store.clear()
+
+    yield
+
+    worker_state.clear()
+    worker_state.update(initial_state)
+    idempotency_store.clear()
+
+
+def test_liveness(db):
+    response = client.get("/health/live")
+
+    assert response.status_code == 200
+    assert response.json()["status"] == "alive"
+
+
+def test_ready_only_after_warm_up(db, cold_worker):
+    # The TestClient doesn't run startup events, so the worker hasn't warmed up yet
+    assert client.get("/health/ready").status_code == 503
+
+    warm_up(bind=engine, session_factory=TestingSessionLocal, pool_size=2)
+    response = client.get("/health/ready")
+
+    assert response.status_code == 200
+    assert response.json()["cold_start_ms"] >= response.json()["warm_up_ms"] > 0
@@ -0,0 +1,71 @@
+import logging
+import os
+import time
+
+from sqlalchemy.orm import configure_mappers
+
+import backend
+from backend.crud import expiry as expiry_crud
+from backend.crud import payer as payer_crud
+from backend.database.config import engine, SessionLocal, DB_POOL_SIZE
+from backend.idempotency import idempotency_store
+
+
+logger = logging.getLogger(__name__)
+
+# Read by the readiness endpoint
+state = {"ready": False, "cold_start_ms": None, "warm_up_ms": None}
+
+
+def process_age_seconds():
+    """
+    Seconds since this process was started, including interpreter startup and imports.
+    None where /proc is not available
+    """
+    try:
+        with open("/proc/self/stat") as f:
+            # The process name can contain spaces, so split after it. Start time is field 22, in clock ticks since boot
+            start_ticks = int(f.read().rsplit(")", 1)[1].split()[19])
+        with open("/proc/uptime") as f:
+            uptime = float(f.read().split()[0])
+    except (OSError, IndexError, ValueError):
+        return None
+
+    return uptime - start_ticks / os.sysconf("SC_CLK_TCK")
+
+
+def warm_up(bind=engine, session_factory=SessionLocal, pool_size: int = DB_POOL_SIZE):
+    """
+    Get a worker ready to serve: open the pooled DB connections, set up the ORM and fill the in-memory caches
+    """
+    start = time.perf_counter()
+
+    # Building the mappers otherwise happens on the first query
+    configure_mappers()
+
+    # Check out every pooled connection at once so they are all opened now, then return them to the pool
+    connections = [bind.connect() for _ in range(pool_size)]
+    for connection in connections:
+        connection.execute("SELECT 1")
+        connection.close()
+
+    db = session_factory()
+    try:
+        primed = idempotency_store.prime(db=db)
+        # Run the common read queries once
+        expiry_crud.get_policies(db=db)
+        payer_crud.get_payer_liabilities(db=db)
+    finally:
+        db.close()
+
+    now = time.perf_counter()
+    process_age = process_age_seconds()
+    state["warm_up_ms"] = (now - start) * 1000
+    # Without /proc, fall back to timing from the import of the backend package, which misses interpreter startup
+    state["cold_start_ms"] = process_age * 1000 if process_age is not None else (now - backend.started_at) * 1000
+    state["ready"] = True
+
+    logger.info(
+        "Worker %s ready in %.1fms (warm-up %.1fms, %s idempotent responses cached)",
+        os.getpid(), state["cold_start_ms"], state["warm_up_ms"], primed,
+    )